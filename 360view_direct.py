@@ -9,11 +9,21 @@ Streamlit 없이 바로 Open3D 뷰어를 실행합니다.
 """
 
 import argparse
+import functools
+import math
 import numpy as np
 import open3d as o3d
 import trimesh
 from pathlib import Path
 
+try:
+    from numba import njit
+except ImportError:  # numba가 없으면 순수 Python으로 실행
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda fn: fn
+
 
 # ============================================================================
 # 🎛️ 빠른 설정 (코드에서 직접 수정 가능)
@@ -27,6 +37,7 @@ QUICK_SETTINGS = {
     
     # 시각화 설정
     'max_points': 3000000,                # 표시할 최대 포인트 수
+    'voxel_downsample': True,             # True: 복셀 그리드, False: 무작위 샘플링
     'point_size': 10.0,                   # 포인트 크기
     'fov': 100,                           # 시야각 (도)
     'bgcolor': 'black',                   # 배경색 (black/white/gray/darkgray)
@@ -46,34 +57,322 @@ QUICK_SETTINGS = {
 
 # ============================================================================
 
+# 배경색 이름 → RGB
+_BGCOLOR_LUT = {
+    name: np.array(rgb, dtype=np.float32)
+    for name, rgb in {
+        "black": (0.0, 0.0, 0.0),
+        "white": (1.0, 1.0, 1.0),
+        "gray": (0.5, 0.5, 0.5),
+        "darkgray": (0.2, 0.2, 0.2)
+    }.items()
+}
+
 
-def load_ply(ply_path):
-    """PLY 파일 로드"""
-    if not Path(ply_path).exists():
-        raise FileNotFoundError(f"PLY 파일을 찾을 수 없습니다: {ply_path}")
-    
+# PLY 속성 타입 → numpy dtype 코드
+_PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+# 헤더 키워드별 최소 토큰 수 (예: "element vertex 100")
+_PLY_HEADER_MIN_TOKENS = {'format': 2, 'element': 3, 'property': 3}
+
+
+def _parse_ply_header(f):
+    """바이너리 PLY 헤더 파싱 → (vertex 개수, vertex 구조체 dtype)
+
+    vertex가 첫 element인 binary PLY만 지원하며, 그 외에는 ValueError를 발생시킵니다.
+    """
+    if f.readline().strip() != b'ply':
+        raise ValueError("PLY 시그니처가 없습니다")
+    
+    fmt = None
+    count = None
+    fields = []
+    element = None
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError("end_header를 찾을 수 없습니다")
+        tokens = line.decode('ascii', errors='replace').split()
+        if not tokens:
+            continue
+        if len(tokens) < _PLY_HEADER_MIN_TOKENS.get(tokens[0], 1):
+            raise ValueError(f"잘못된 PLY 헤더 줄: {line!r}")
+        if tokens[0] == 'format':
+            fmt = tokens[1]
+        elif tokens[0] == 'element':
+            element = tokens[1]
+            if element == 'vertex':
+                count = int(tokens[2])
+            elif count is None:
+                raise ValueError("vertex 앞에 다른 element가 있습니다")
+        elif tokens[0] == 'property' and element == 'vertex':
+            if tokens[1] == 'list' or tokens[1] not in _PLY_TYPES:
+                raise ValueError(f"지원하지 않는 vertex 속성: {' '.join(tokens[1:])}")
+            fields.append((tokens[2], _PLY_TYPES[tokens[1]]))
+        elif tokens[0] == 'end_header':
+            break
+    
+    endian = {'binary_little_endian': '<', 'binary_big_endian': '>'}.get(fmt)
+    if endian is None:
+        raise ValueError(f"바이너리 PLY가 아닙니다: {fmt}")
+    types = dict(fields)
+    if count is None or not {'x', 'y', 'z'} <= types.keys():
+        raise ValueError("vertex x/y/z 속성이 없습니다")
+    # 컬러는 uchar(0~255)만 직접 처리, 그 외 타입은 trimesh에 맡김
+    if any(types.get(name, 'u1') != 'u1' for name in ('red', 'green', 'blue')):
+        raise ValueError("uchar가 아닌 vertex 컬러 속성")
+    
+    return count, np.dtype([(name, endian + code) for name, code in fields])
+
+
+def _load_ply_trimesh(ply_path):
+    """trimesh로 PLY 로드 (ASCII 등 직접 파싱이 불가능한 경우)"""
     mesh = trimesh.load(str(ply_path), process=False)
-    pts = np.asarray(mesh.vertices)
+    pts = np.asarray(mesh.vertices, dtype=np.float32)
     cols = None
     
     if hasattr(mesh, "visual") and hasattr(mesh.visual, "vertex_colors"):
         vc = np.asarray(mesh.visual.vertex_colors)
-        cols = vc[:, :3] / 255.0
+        cols = np.empty((len(vc), 3), dtype=np.float32)
+        np.divide(vc[:, :3], np.float32(255.0), out=cols)
+    
+    return pts, cols
+
+
+def _sample_indices(n, k):
+    """0..n-1 중 k개를 비복원 무작위 샘플링 (오름차순 정렬)"""
+    # shuffle=False: 전체 순열 없이 인덱스만 샘플링
+    rng = np.random.default_rng()
+    idx = rng.choice(n, size=k, replace=False, shuffle=False)
+    idx.sort()
+    return idx
+
+
+def load_ply(ply_path, max_points=None):
+    """PLY 파일 로드
+
+    max_points가 주어지면 바이너리 PLY는 무작위로 선택된 포인트만 읽습니다.
+    """
+    if not Path(ply_path).exists():
+        raise FileNotFoundError(f"PLY 파일을 찾을 수 없습니다: {ply_path}")
+    
+    try:
+        # 바이너리 PLY는 헤더만 직접 파싱하고 본문은 구조체 배열로 메모리 매핑
+        with open(ply_path, 'rb') as f:
+            count, dtype = _parse_ply_header(f)
+            offset = f.tell()
+        raw = np.memmap(ply_path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+        
+        if max_points is not None and count > max_points:
+            # 정렬된 인덱스로 순차 접근 → 필요한 페이지만 디스크에서 읽음
+            print(f"🔽 다운샘플링 (로드 시): {count:,} → {max_points:,} 포인트")
+            raw = raw[_sample_indices(count, max_points)]
+        
+        pts = np.stack([raw['x'], raw['y'], raw['z']], axis=1)
+        cols = None
+        if {'red', 'green', 'blue'} <= set(dtype.names):
+            # uint8 채널을 float32 버퍼에 바로 정규화 (중간 배열 없음)
+            cols = np.empty((len(raw), 3), dtype=np.float32)
+            for i, name in enumerate(('red', 'green', 'blue')):
+                np.divide(raw[name], np.float32(255.0), out=cols[:, i])
+        del raw
+    except ValueError:
+        pts, cols = _load_ply_trimesh(ply_path)
     
     print(f"✅ PLY 로드 완료: {len(pts):,}개 포인트")
     return pts, cols
 
 
-def downsample(pts, cols, max_points):
+def _random_downsample(pts, cols, max_points):
+    """무작위 포인트 다운샘플링"""
+    idx = _sample_indices(len(pts), max_points)
+    pts = np.take(pts, idx, axis=0)
+    cols = np.take(cols, idx, axis=0) if cols is not None else None
+    return pts, cols
+
+
+def _voxel_keys(pts, bbox_min, voxel_size):
+    """포인트 → 정수 복셀 좌표를 축당 21비트로 패킹한 uint64 키"""
+    q = np.floor((pts - bbox_min) / voxel_size).astype(np.int32)
+    np.clip(q, 0, (1 << 21) - 1, out=q)
+    q = q.astype(np.uint64)
+    return (q[:, 0] << np.uint64(42)) | (q[:, 1] << np.uint64(21)) | q[:, 2]
+
+
+def _tune_voxel_size(pts, bbox_min, bbox_size, target, max_iter=30, tol=0.995):
+    """voxel_size 이분 탐색 → 복셀 수가 target 이하이면서 가장 가까운 크기 (없으면 None)"""
+    # 초기값: 포인트가 바운딩 박스 표면에 고르게 분포한다고 보고 목표 밀도로 추정
+    sx, sy, sz = bbox_size
+    area = 2.0 * (sx * sy + sy * sz + sz * sx)
+    voxel_size = math.sqrt(area / target) if area > 0.0 else float(bbox_size.max()) / target
+    # 축당 21비트 키 범위를 넘지 않는 최소 복셀 크기
+    min_voxel = float(bbox_size.max()) / ((1 << 21) - 1)
+    voxel_size = max(voxel_size, min_voxel)
+    
+    lo = hi = None  # lo: 복셀 수 > target, hi: 복셀 수 <= target
+    best = None
+    for _ in range(max_iter):
+        n = len(np.unique(_voxel_keys(pts, bbox_min, voxel_size)))
+        if n <= target:
+            hi = voxel_size
+            if best is None or n > best[0]:
+                best = (n, voxel_size)
+            if n >= tol * target:
+                break
+        else:
+            lo = voxel_size
+        
+        if lo is None:
+            voxel_size = max(hi / 2.0, min_voxel)
+            if voxel_size == hi:
+                break
+        elif hi is None:
+            voxel_size = lo * 2.0
+        else:
+            voxel_size = math.sqrt(lo * hi)
+    
+    return None if best is None else best[1]
+
+
+def _sample_voxel_target(n_total, n_sample, max_points):
+    """전체에서 max_points개 복셀이 점유될 때 n_sample개 샘플이 점유하는 복셀 수 추정
+
+    복셀당 포인트 수를 Poisson(λ)로 보면 점유 복셀 수 = V(1 - e^-λ), N = Vλ 이고,
+    비율 f = n_sample / N 인 샘플의 점유 복셀 수는 V(1 - e^-fλ) 입니다.
+    """
+    ratio = max_points / n_total
+    # (1 - e^-λ) / λ = ratio 를 만족하는 λ (λ에 대해 단조 감소)
+    lo, hi = 1e-9, 1.0
+    while (1.0 - math.exp(-hi)) / hi > ratio:
+        hi *= 2.0
+    for _ in range(60):
+        mid = 0.5 * (lo + hi)
+        if (1.0 - math.exp(-mid)) / mid > ratio:
+            lo = mid
+        else:
+            hi = mid
+    lam = 0.5 * (lo + hi)
+    return (n_total / lam) * -math.expm1(-lam * n_sample / n_total)
+
+
+def _voxel_downsample(pts, cols, max_points, sample_size=200000):
+    """복셀 그리드 다운샘플링 (복셀마다 첫 번째 포인트를 대표로 유지)
+
+    voxel_size는 sample_size개의 무작위 부분집합에서 탐색하고,
+    전체 포인트에는 복셀 키 계산과 np.unique를 한 번만 수행합니다.
+    결과가 max_points를 넘으면 대표 포인트를 무작위로 덜어냅니다.
+    """
+    n_total = len(pts)
+    bbox_min = pts.min(axis=0)
+    bbox_size = (pts.max(axis=0) - bbox_min).astype(np.float64)
+    if not np.any(bbox_size > 0.0):
+        return None, None
+    
+    if n_total > sample_size:
+        sample = np.take(pts, _sample_indices(n_total, sample_size), axis=0)
+        target = _sample_voxel_target(n_total, sample_size, max_points)
+    else:
+        sample = pts
+        target = max_points
+    
+    voxel_size = _tune_voxel_size(sample, bbox_min, bbox_size, max(int(target), 1))
+    if voxel_size is None:
+        return None, None
+    print(f"   - 복셀 크기: {voxel_size:.5f}")
+    
+    _, idx = np.unique(_voxel_keys(pts, bbox_min, voxel_size), return_index=True)
+    if len(idx) > max_points:
+        idx = idx[_sample_indices(len(idx), max_points)]
+    # 원래 순서 유지 (순차 메모리 접근)
+    idx.sort()
+    out_pts = np.take(pts, idx, axis=0)
+    out_cols = np.take(cols, idx, axis=0) if cols is not None else None
+    return out_pts, out_cols
+
+
+def downsample(pts, cols, max_points, voxel=True):
     """포인트 다운샘플링"""
     if len(pts) > max_points:
         print(f"🔽 다운샘플링: {len(pts):,} → {max_points:,} 포인트")
-        idx = np.random.choice(len(pts), max_points, replace=False)
-        pts = pts[idx]
-        cols = cols[idx] if cols is not None else None
+        if voxel:
+            down_pts, down_cols = _voxel_downsample(pts, cols, max_points)
+            if down_pts is not None:
+                print(f"   - 복셀 다운샘플링 결과: {len(down_pts):,} 포인트")
+                return down_pts, down_cols
+            # 복셀 그리드를 만들 수 없거나 탐색이 수렴하지 않은 경우 무작위 샘플링으로 대체
+            print("   ⚠️  복셀 다운샘플링 실패 → 무작위 샘플링으로 대체")
+        pts, cols = _random_downsample(pts, cols, max_points)
     return pts, cols
 
 
+@njit(inline='always')
+def _store(extrinsic, i, j, value):
+    """extrinsic[i, j] = value, 값이 1e-9 넘게 바뀌었으면 True"""
+    old = extrinsic[i, j]
+    extrinsic[i, j] = value
+    return abs(old - value) > 1e-9
+
+
+@njit(cache=True)
+def _reorthonormalize(extrinsic, initial_y):
+    """extrinsic(4x4)의 수직 회전을 제거하고 회전 행렬을 제자리에서 재직교화
+
+    원소가 1e-9 넘게 바뀌었으면 True를 반환합니다. 반올림 오차 때문에
+    잠금이 안정된 뒤에도 1~2 프레임 동안 True가 나올 수 있습니다.
+    """
+    # Y축(up)이 위를 향하도록 강제 (0, ±1, 0)
+    up_y = -1.0 if extrinsic[1, 1] < 0.0 else 1.0
+    
+    # Z축(전방)에서 Y 성분 제거 후 정규화 (수평 유지)
+    fx = extrinsic[0, 2]
+    fz = extrinsic[2, 2]
+    norm = math.sqrt(fx * fx + fz * fz) + 1e-10
+    fx /= norm
+    fz /= norm
+    
+    # X축(우측) = up × forward
+    rx = up_y * fz
+    rz = -up_y * fx
+    norm = math.sqrt(rx * rx + rz * rz) + 1e-10
+    rx /= norm
+    rz /= norm
+    
+    # 회전 열 [right | up | forward] 기록, Y축 위치는 초기값으로 고정 (높이 변화 방지)
+    changed = _store(extrinsic, 0, 0, rx)
+    changed |= _store(extrinsic, 1, 0, 0.0)
+    changed |= _store(extrinsic, 2, 0, rz)
+    changed |= _store(extrinsic, 0, 1, 0.0)
+    changed |= _store(extrinsic, 1, 1, up_y)
+    changed |= _store(extrinsic, 2, 1, 0.0)
+    changed |= _store(extrinsic, 0, 2, fx)
+    changed |= _store(extrinsic, 1, 2, 0.0)
+    changed |= _store(extrinsic, 2, 2, fz)
+    changed |= _store(extrinsic, 1, 3, initial_y)
+    return changed
+
+
+@functools.lru_cache(maxsize=8)
+def _make_extrinsic(distance):
+    """카메라 Extrinsic 행렬 (회전 없이 (0, 0, distance)에 배치, 읽기 전용)"""
+    # Extrinsic = [R | t], R = I 이므로 t = -camera_position
+    extrinsic = np.eye(4, dtype=np.float64)
+    extrinsic[2, 3] = -float(distance)
+    extrinsic.setflags(write=False)
+    return extrinsic
+
+
+@functools.lru_cache(maxsize=8)
+def _make_intrinsic(width, height, fov_deg):
+    """FOV로부터 Intrinsic 파라미터 계산 → (width, height, fx, fy, cx, cy)"""
+    focal_length = width / (2.0 * math.tan(math.radians(fov_deg / 2.0)))
+    return width, height, focal_length, focal_length, width / 2.0, height / 2.0
+
+
 def show_open3d_viewer(pts, cols, args):
     """Open3D 3D 뷰어 실행 (360도 내부 시점)"""
     
@@ -92,9 +391,10 @@ def show_open3d_viewer(pts, cols, args):
     print(f"바운딩 박스 크기: [{bbox_size[0]:.3f}, {bbox_size[1]:.3f}, {bbox_size[2]:.3f}]")
     print("="*60 + "\n")
     
-    # 포인트 반전 (내부 시점)
+    # 포인트 반전 (내부 시점) - float32 변환과 한 번에 처리
+    sign = -1.0 if args.invert else 1.0
+    pts = np.multiply(pts, np.float32(sign), dtype=np.float32, casting='unsafe')
     if args.invert:
-        pts = -pts
         print("🔄 포인트 반전: 내부 시점으로 전환")
     
     # 포인트클라우드 생성
@@ -126,13 +426,7 @@ def show_open3d_viewer(pts, cols, args):
     opt = vis.get_render_option()
     
     # 배경색 설정
-    bgcolor_map = {
-        "black": (0.0, 0.0, 0.0),
-        "white": (1.0, 1.0, 1.0),
-        "gray": (0.5, 0.5, 0.5),
-        "darkgray": (0.2, 0.2, 0.2)
-    }
-    opt.background_color = np.array(bgcolor_map.get(args.bgcolor, (0.0, 0.0, 0.0)), dtype=np.float32)
+    opt.background_color = _BGCOLOR_LUT[args.bgcolor]
     opt.point_size = float(args.size)
     opt.show_coordinate_frame = args.axis
     
@@ -150,32 +444,10 @@ def show_open3d_viewer(pts, cols, args):
     params = ctr.convert_to_pinhole_camera_parameters()
     
     # Extrinsic 행렬 (카메라를 정확히 원점에 배치)
-    camera_position = np.array([0.0, 0.0, args.distance])
-    
-    # 항등 회전 행렬 (회전 없음)
-    R = np.eye(3, dtype=np.float64)
-    
-    # Extrinsic = [R | t] 여기서 t = -R @ camera_position
-    extrinsic = np.eye(4, dtype=np.float64)
-    extrinsic[:3, :3] = R
-    extrinsic[:3, 3] = -R @ camera_position
-    
-    params.extrinsic = extrinsic
+    params.extrinsic = _make_extrinsic(args.distance)
     
     # Intrinsic 행렬 (FOV 설정)
-    intrinsic = params.intrinsic
-    intrinsic.width = args.width
-    intrinsic.height = args.height
-    focal_length = intrinsic.width / (2.0 * np.tan(np.radians(args.fov / 2.0)))
-    intrinsic.set_intrinsics(
-        intrinsic.width,
-        intrinsic.height,
-        focal_length,
-        focal_length,
-        intrinsic.width / 2.0,
-        intrinsic.height / 2.0
-    )
-    params.intrinsic = intrinsic
+    params.intrinsic = o3d.camera.PinholeCameraIntrinsic(*_make_intrinsic(args.width, args.height, args.fov))
     
     # 카메라 파라미터 적용
     ctr.convert_from_pinhole_camera_parameters(params, allow_arbitrary=True)
@@ -184,44 +456,20 @@ def show_open3d_viewer(pts, cols, args):
     if args.horizontal_only:
         # 초기 카메라 상태 저장
         initial_params = ctr.convert_to_pinhole_camera_parameters()
-        initial_y = initial_params.extrinsic[1, 3]  # Y 위치 저장
+        initial_y = float(initial_params.extrinsic[1, 3])  # Y 위치 저장
+        scratch_ext = np.empty((4, 4), dtype=np.float64)
         
         def lock_vertical_rotation(vis):
             """수직 회전을 잠그고 수평 회전만 허용"""
-            ctr = vis.get_view_control()
+            # 현재 카메라 상태는 매 프레임 읽어야 하므로 변환은 한 번만 수행
             params = ctr.convert_to_pinhole_camera_parameters()
+            np.copyto(scratch_ext, params.extrinsic)
             
-            # Y축 위치를 초기값으로 고정 (높이 변화 방지)
-            extrinsic = params.extrinsic.copy()
-            extrinsic[1, 3] = initial_y
-            
-            # Y축 회전 성분 제한 (pitch 제한)
-            # extrinsic의 회전 행렬에서 Y축 회전을 0으로 유지
-            R = extrinsic[:3, :3]
-            
-            # Y축 방향 벡터 추출
-            up = R[:, 1]
-            # Y축이 위를 향하도록 강제 (0, 1, 0에 가깝게)
-            up[0] = 0.0  # X 성분 제거
-            up[2] = 0.0  # Z 성분 제거
-            up[1] = -1.0 if up[1] < 0 else 1.0  # Y 방향 유지
-            
-            # 정규화된 Y축으로 회전 행렬 재구성
-            R[:, 1] = up / np.linalg.norm(up)
-            
-            # Z축(전방)과 X축(우측)을 재계산하여 직교성 유지
-            forward = R[:, 2]
-            forward[1] = 0.0  # Y 성분 제거 (수평 유지)
-            forward = forward / (np.linalg.norm(forward) + 1e-10)
-            R[:, 2] = forward
-            
-            right = np.cross(up, forward)
-            right = right / (np.linalg.norm(right) + 1e-10)
-            R[:, 0] = right
-            
-            extrinsic[:3, :3] = R
-            params.extrinsic = extrinsic
+            # 이미 잠긴 상태면 C++ 쪽으로 다시 보내지 않음 (유휴 프레임 비용 제거)
+            if not _reorthonormalize(scratch_ext, initial_y):
+                return False
             
+            params.extrinsic = scratch_ext
             ctr.convert_from_pinhole_camera_parameters(params, allow_arbitrary=True)
             return False
         
@@ -279,6 +527,13 @@ def main():
         help=f"표시할 최대 포인트 수 (기본값: {QUICK_SETTINGS['max_points']})"
     )
     
+    parser.add_argument(
+        "--no-voxel",
+        dest="voxel",
+        action="store_false",
+        help="복셀 다운샘플링 대신 무작위 샘플링 사용"
+    )
+    
     parser.add_argument(
         "--size",
         type=float,
@@ -306,7 +561,7 @@ def main():
         "--bgcolor",
         type=str,
         default=QUICK_SETTINGS['bgcolor'],
-        choices=["black", "white", "gray", "darkgray"],
+        choices=list(_BGCOLOR_LUT),
         help=f"배경색 (기본값: {QUICK_SETTINGS['bgcolor']})"
     )
     
@@ -355,6 +610,7 @@ def main():
     # 기본값 설정
     parser.set_defaults(
         invert=QUICK_SETTINGS['invert_points'],
+        voxel=QUICK_SETTINGS['voxel_downsample'],
         normals=True,
         axis=QUICK_SETTINGS['show_axis'],
         horizontal_only=QUICK_SETTINGS['horizontal_only']
@@ -369,11 +625,11 @@ def main():
     print(f"PLY 파일: {args.ply}\n")
     
     try:
-        # PLY 로드
-        pts, cols = load_ply(args.ply)
+        # PLY 로드 (무작위 샘플링이면 로드 단계에서 바로 샘플링)
+        pts, cols = load_ply(args.ply, max_points=None if args.voxel else args.points)
         
         # 다운샘플링
-        pts, cols = downsample(pts, cols, args.points)
+        pts, cols = downsample(pts, cols, args.points, voxel=args.voxel)
         
         # 뷰어 실행
         show_open3d_viewer(pts, cols, args)
@@ -1,17 +1,33 @@
 import os
-import io
+import sys
+import re
 import json
+import atexit
 import base64
+import queue
+import signal
+import hashlib
 import logging
+import multiprocessing
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from uuid import uuid4
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
 from flasgger import Swagger
 from dotenv import load_dotenv
+import orjson
 import requests
-import trimesh
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from model_convert import convert_model
 
 
 # --------------------------------------
@@ -22,6 +38,10 @@ load_dotenv()
 APP_PORT = int(os.getenv("PORT", "5001"))
 MESHY_API_KEY = os.getenv("MESHY_API_KEY")
 MESHY_API_URL = os.getenv("MESHY_API_URL", "https://api.meshy.ai/openapi/v1/image-to-3d")
+# Public URL of this server (e.g. https://example.com); when set, uploads are
+# passed to Meshy by URL instead of as base64 data URLs
+PUBLIC_BASE_URL = (os.getenv("PUBLIC_BASE_URL") or "").rstrip("/")
+UPLOAD_EXTENSIONS = {".png", ".jpg", ".jpeg"}
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
@@ -30,9 +50,27 @@ OUTPUTS_DIR = os.path.join(DATA_DIR, "outputs")
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 os.makedirs(OUTPUTS_DIR, exist_ok=True)
 
+
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson."""
+
+    def dumps(self, obj, **kwargs):
+        # Non-str keys show up in the Swagger spec (e.g. integer status codes)
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# Gzip JSON responses only; model files are binary and gain little
+app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+app.config["COMPRESS_MIN_SIZE"] = 500
+Compress(app)
+
 # Swagger configuration
 swagger_template = {
     "swagger": "2.0",
@@ -48,13 +86,38 @@ Swagger(app, template=swagger_template)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("app_flask")
 
+# Shared HTTP session so Meshy calls reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        # raise_on_status=False: return the last response so handlers report Meshy's error
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False,
+        ),
+    ),
+)
+_MESHY_HEADERS = {"Authorization": f"Bearer {MESHY_API_KEY}"} if MESHY_API_KEY else None
+
+# Background GLB -> OBJ/PLY conversions: (task_id, fmt) -> (future, executor)
+_EXECUTOR = None
+_CONVERSIONS = {}
+_CONVERSIONS_LOCK = threading.Lock()
+_TASK_ID_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+MODEL_MAX_AGE = 31536000  # 1 year
+
 
 def _meshy_headers():
-    if not MESHY_API_KEY:
+    if _MESHY_HEADERS is None:
         raise RuntimeError(
             "MESHY_API_KEY가 설정되지 않았습니다. 환경 변수나 .env 파일에 키를 추가해주세요."
         )
-    return {"Authorization": f"Bearer {MESHY_API_KEY}"}
+    return _MESHY_HEADERS
 
 
 def _save_meta(task_id: str, meta: dict):
@@ -67,6 +130,149 @@ def _save_meta(task_id: str, meta: dict):
     except Exception as e:
         logger.warning("Failed to write meta for %s: %s", task_id, e)
 
+
+# Meta files are written by a single background thread so request handlers
+# never block on disk I/O
+_META_Q = queue.Queue()
+
+
+def _meta_worker():
+    while True:
+        task_id, meta = _META_Q.get()
+        try:
+            _save_meta(task_id, meta)
+        except Exception:
+            # Keep the single writer alive; one bad task must not drop later metas
+            logger.exception("Failed to save meta for %s", task_id)
+        finally:
+            _META_Q.task_done()
+
+
+threading.Thread(target=_meta_worker, name="meta-writer", daemon=True).start()
+# Flush pending metas on shutdown; otherwise a meta queued just before exit is lost
+atexit.register(_META_Q.join)
+
+
+def _download_to_file(url: str, dest: str) -> str:
+    """Stream a remote file to dest via a temporary file in the same directory."""
+    dest_dir = os.path.dirname(dest)
+    os.makedirs(dest_dir, exist_ok=True)
+    with SESSION.get(url, stream=True, timeout=180) as r:
+        r.raise_for_status()
+        with tempfile.NamedTemporaryFile(dir=dest_dir, delete=False, suffix=".part") as tmp:
+            try:
+                for chunk in r.iter_content(chunk_size=1 << 20):
+                    tmp.write(chunk)
+            except Exception:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+    os.replace(tmp.name, dest)
+    return dest
+
+
+def _model_path(task_id: str, fmt: str) -> str:
+    return os.path.join(OUTPUTS_DIR, task_id, f"model.{fmt}")
+
+
+def _executor() -> ProcessPoolExecutor:
+    # Created lazily so spawned worker processes do not build their own pool
+    global _EXECUTOR
+    with _CONVERSIONS_LOCK:
+        if _EXECUTOR is None:
+            # spawn, not fork: this process is multi-threaded (meta writer,
+            # request threads), and forking it can deadlock the workers
+            _EXECUTOR = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _EXECUTOR
+
+
+def _reset_executor(broken: ProcessPoolExecutor):
+    """Drop a broken pool (e.g. a worker was OOM-killed) so the next call builds a new one."""
+    global _EXECUTOR
+    with _CONVERSIONS_LOCK:
+        if _EXECUTOR is broken:
+            _EXECUTOR = None
+    broken.shutdown(wait=False)
+
+
+def _forget_conversion(key, future):
+    # Successful conversions are served from disk, so their entry is no longer
+    # needed; failed ones stay until a poll reports the error
+    if future.cancelled() or future.exception() is not None:
+        return
+    with _CONVERSIONS_LOCK:
+        entry = _CONVERSIONS.get(key)
+        if entry is not None and entry[0] is future:
+            del _CONVERSIONS[key]
+
+
+def _submit_conversion(key, glb_path: str, out_path: str, fmt: str):
+    def submit():
+        executor = _executor()
+        with _CONVERSIONS_LOCK:
+            if key in _CONVERSIONS:
+                return None
+            try:
+                future = executor.submit(convert_model, glb_path, out_path, fmt)
+            except BrokenProcessPool:
+                return executor
+            _CONVERSIONS[key] = (future, executor)
+        # Outside the lock: the callback runs immediately if the future is already done
+        future.add_done_callback(lambda f: _forget_conversion(key, f))
+        return None
+
+    broken = submit()
+    if broken is not None:
+        _reset_executor(broken)
+        broken = submit()
+        if broken is not None:
+            raise BrokenProcessPool("Conversion process pool is not usable")
+
+
+def _file_etag(path: str) -> str:
+    """SHA-256 of a cached model file, memoized in a sidecar .etag file."""
+    etag_path = f"{path}.etag"
+    try:
+        with open(etag_path, "r", encoding="ascii") as f:
+            cached = f.read().strip()
+        if cached:
+            return cached
+    except OSError:
+        pass
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    etag = digest.hexdigest()
+    try:
+        # Write via a temp file so concurrent readers never see a partial sidecar
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="ascii", dir=os.path.dirname(path), delete=False, suffix=".part"
+        ) as tmp:
+            tmp.write(etag)
+        os.replace(tmp.name, etag_path)
+    except OSError as e:
+        logger.warning("Failed to write etag for %s: %s", path, e)
+    return etag
+
+
+def _send_model(path: str, task_id: str, fmt: str):
+    # Generated models never change for a task, so let browsers/CDNs keep them
+    response = send_file(
+        path,
+        mimetype="model/gltf-binary" if fmt == "glb" else "application/octet-stream",
+        as_attachment=False,
+        download_name=f"{task_id}.{fmt}",
+        max_age=MODEL_MAX_AGE,
+        conditional=True,
+        etag=_file_etag(path),
+    )
+    response.headers["Cache-Control"] = f"public, immutable, max-age={MODEL_MAX_AGE}"
+    return response
+
 # 단순히 백엔드가 살아있는지 확인하는 API
 @app.get("/health")
 def health():
@@ -219,20 +425,30 @@ def process_image():
         if image_bytes is None and image_data_url is None:
             return jsonify({"error": "No image provided. Use multipart 'image' or JSON 'image_base64'/'image_url'."}), 400
 
-        # Form data URL if needed
-        if image_data_url is None and image_bytes is not None:
-            img_b64 = base64.b64encode(image_bytes).decode("utf-8")
-            image_data_url = f"data:image/png;base64,{img_b64}"
-
         # Optionally persist upload
+        upload_name = None
         if image_bytes is not None:
             stamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-            up_id = f"{stamp}_{uuid4().hex[:8]}"
+            # Uploads served to Meshy by URL get a full unguessable id
+            up_id = f"{stamp}_{uuid4().hex if PUBLIC_BASE_URL else uuid4().hex[:8]}"
+            ext = os.path.splitext(original_filename or "")[1].lower()
+            if ext not in UPLOAD_EXTENSIONS:
+                ext = ".png"
+            upload_name = f"{up_id}{ext}"
             try:
-                with open(os.path.join(UPLOADS_DIR, f"{up_id}_{original_filename or 'upload'}.bin"), "wb") as f:
+                with open(os.path.join(UPLOADS_DIR, upload_name), "wb") as f:
                     f.write(image_bytes)
             except Exception:
-                pass
+                upload_name = None
+
+        # Form image URL if needed: hand Meshy a link to the stored upload when
+        # this server is publicly reachable, otherwise inline it as a data URL
+        if image_data_url is None and image_bytes is not None:
+            if PUBLIC_BASE_URL and upload_name:
+                image_data_url = f"{PUBLIC_BASE_URL}/api/uploads/{upload_name}"
+            else:
+                img_b64 = base64.b64encode(image_bytes).decode("utf-8")
+                image_data_url = f"data:image/png;base64,{img_b64}"
 
         # Call Meshy
         payload = {
@@ -243,19 +459,20 @@ def process_image():
             "ai_model": ai_model,
         }
 
-        resp = requests.post(MESHY_API_URL, headers=_meshy_headers(), json=payload, timeout=60)
+        resp = SESSION.post(MESHY_API_URL, headers=_meshy_headers(), json=payload, timeout=60)
         if not resp.ok:
             try:
-                detail = resp.json()
+                detail = orjson.loads(resp.content)
             except Exception:
                 detail = {"text": resp.text}
             return jsonify({"error": "Meshy create failed", "detail": detail}), resp.status_code
 
-        task_id = (resp.json() or {}).get("result")
+        data = orjson.loads(resp.content) or {}
+        task_id = data.get("result")
         if not task_id:
-            return jsonify({"error": "Invalid Meshy response", "detail": resp.json()}), 502
+            return jsonify({"error": "Invalid Meshy response", "detail": data}), 502
 
-        _save_meta(
+        _META_Q.put_nowait((
             task_id,
             {
                 "original_filename": original_filename,
@@ -266,7 +483,7 @@ def process_image():
                     "ai_model": ai_model,
                 },
             },
-        )
+        ))
 
         return jsonify({"task_id": task_id}), 202
     except RuntimeError as re:
@@ -275,6 +492,33 @@ def process_image():
         logger.exception("/api/process-image failed")
         return jsonify({"error": "Internal server error", "detail": str(e)}), 500
 
+# 업로드된 이미지 제공 API (Meshy가 image_url로 가져감)
+@app.get("/api/uploads/<name>")
+def get_upload(name: str):
+    """Serve a stored upload image
+    ---
+    tags:
+      - processing
+    parameters:
+      - in: path
+        name: name
+        type: string
+        required: true
+        description: Stored upload file name
+    produces:
+      - image/png
+      - image/jpeg
+    responses:
+      200:
+        description: Image file stream
+      404:
+        description: Upload not found
+    """
+    # Only exposed when uploads are handed to Meshy by URL
+    if not PUBLIC_BASE_URL or os.path.splitext(name)[1].lower() not in UPLOAD_EXTENSIONS:
+        return jsonify({"error": "Upload not found"}), 404
+    return send_from_directory(UPLOADS_DIR, name, max_age=3600)
+
 # 3D 작업 상태 조회 API
 @app.get("/api/status/<task_id>")
 def get_status(task_id: str):
@@ -312,14 +556,14 @@ def get_status(task_id: str):
     """
     try:
         url = f"{MESHY_API_URL}/{task_id}"
-        resp = requests.get(url, headers=_meshy_headers(), timeout=30)
+        resp = SESSION.get(url, headers=_meshy_headers(), timeout=30)
         if not resp.ok:
             try:
-                detail = resp.json()
+                detail = orjson.loads(resp.content)
             except Exception:
                 detail = {"text": resp.text}
             return jsonify({"error": "Meshy status failed", "detail": detail}), resp.status_code
-        data = resp.json() or {}
+        data = orjson.loads(resp.content) or {}
         # Pass through relevant fields
         return jsonify({
             "status": data.get("status"),
@@ -338,6 +582,9 @@ def get_status(task_id: str):
 def get_result(task_id: str):
     """Get the generated model
     Download the generated model in desired format.
+    GLB downloads and converted OBJ/PLY files are cached on disk per task.
+    The first OBJ/PLY request starts a background conversion and returns 202;
+    poll the same URL until the file is returned.
 
     ---
     tags:
@@ -359,6 +606,17 @@ def get_result(task_id: str):
     responses:
       200:
         description: Model file stream
+      202:
+        description: Conversion in progress
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+            poll_url:
+              type: string
+      304:
+        description: Cached copy is still valid (If-None-Match)
       409:
         description: Job not completed
       5XX:
@@ -367,51 +625,56 @@ def get_result(task_id: str):
     fmt = (request.args.get("format") or "glb").lower()
     if fmt not in {"glb", "obj", "ply"}:
         return jsonify({"error": "Unsupported format", "allowed": ["glb", "obj", "ply"]}), 400
+    if not _TASK_ID_RE.match(task_id):
+        return jsonify({"error": "Invalid task id"}), 400
 
-    try:
-        # Check status to get model URL
-        status_url = f"{MESHY_API_URL}/{task_id}"
-        sresp = requests.get(status_url, headers=_meshy_headers(), timeout=30)
-        if not sresp.ok:
-            return jsonify({"error": "Failed to get status from Meshy"}), sresp.status_code
-        sdata = sresp.json() or {}
-        if sdata.get("status") != "SUCCEEDED":
-            return jsonify({"error": "Job not completed", "status": sdata.get("status")}), 409
-
-        model_url = (sdata.get("model_urls") or {}).get("glb")
-        if not model_url:
-            return jsonify({"error": "GLB URL missing in Meshy response"}), 502
+    out_path = _model_path(task_id, fmt)
+    converting = {"status": "CONVERTING", "poll_url": f"/api/result/{task_id}?format={fmt}"}
+    key = (task_id, fmt)
 
-        glb_bytes = requests.get(model_url, timeout=180).content
+    try:
+        if os.path.exists(out_path):
+            return _send_model(out_path, task_id, fmt)
+
+        with _CONVERSIONS_LOCK:
+            entry = _CONVERSIONS.get(key)
+            if entry is not None and entry[0].done():
+                del _CONVERSIONS[key]
+        if entry is not None:
+            future, executor = entry
+            if not future.done():
+                return jsonify(converting), 202
+            ce = future.exception()
+            if ce is not None:
+                if isinstance(ce, BrokenProcessPool):
+                    _reset_executor(executor)
+                logger.error("Conversion of %s to %s failed: %s", task_id, fmt, ce)
+                return jsonify({"error": f"Conversion to {fmt} failed", "detail": str(ce)}), 500
+            return _send_model(out_path, task_id, fmt)
+
+        glb_path = _model_path(task_id, "glb")
+        if not os.path.exists(glb_path):
+            # Check status to get model URL
+            status_url = f"{MESHY_API_URL}/{task_id}"
+            sresp = SESSION.get(status_url, headers=_meshy_headers(), timeout=30)
+            if not sresp.ok:
+                return jsonify({"error": "Failed to get status from Meshy"}), sresp.status_code
+            sdata = orjson.loads(sresp.content) or {}
+            if sdata.get("status") != "SUCCEEDED":
+                return jsonify({"error": "Job not completed", "status": sdata.get("status")}), 409
+
+            model_url = (sdata.get("model_urls") or {}).get("glb")
+            if not model_url:
+                return jsonify({"error": "GLB URL missing in Meshy response"}), 502
+
+            _download_to_file(model_url, glb_path)
 
         if fmt == "glb":
-            return send_file(
-                io.BytesIO(glb_bytes),
-                mimetype="model/gltf-binary",
-                as_attachment=False,
-                download_name=f"{task_id}.glb",
-                max_age=0,
-                last_modified=datetime.utcnow(),
-            )
+            return _send_model(glb_path, task_id, fmt)
 
-        # Convert to other formats
-        try:
-            scene_or_mesh = trimesh.load(io.BytesIO(glb_bytes), file_type="glb")
-            buf = io.BytesIO()
-            scene_or_mesh.export(buf, file_type=fmt)
-            out_bytes = buf.getvalue()
-        except Exception as ce:
-            logger.exception("Conversion to %s failed", fmt)
-            return jsonify({"error": f"Conversion to {fmt} failed", "detail": str(ce)}), 500
-
-        return send_file(
-            io.BytesIO(out_bytes),
-            mimetype="application/octet-stream",
-            as_attachment=False,
-            download_name=f"{task_id}.{fmt}",
-            max_age=0,
-            last_modified=datetime.utcnow(),
-        )
+        # Convert to other formats in the background
+        _submit_conversion(key, glb_path, out_path, fmt)
+        return jsonify(converting), 202
 
     except RuntimeError as re:
         return jsonify({"error": str(re)}), 500
@@ -421,6 +684,8 @@ def get_result(task_id: str):
 
 # 앱 실행
 if __name__ == "__main__":
+    # Exit normally on SIGTERM so atexit handlers (meta flush) run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     # Use 0.0.0.0 so the React dev server can reach it from another host if needed
     # Disable debug/reloader in this run mode for stability during smoke tests
     app.run(host="0.0.0.0", port=APP_PORT, debug=False)
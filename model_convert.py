@@ -0,0 +1,32 @@
+"""GLB -> OBJ/PLY conversion, run in app_flask's worker processes.
+
+Workers unpickle convert_model from here, so they do not need app_flask to find
+it. Under `flask run` or a WSGI server, workers re-run only that launcher's
+light entry script, plus this module and trimesh. When started
+with `python app_flask.py`, spawn still re-runs app_flask's top level in every
+worker (Flask app, Swagger, HTTP session, meta-writer thread). That costs each
+of the os.cpu_count() workers that startup time and memory once per pool.
+"""
+import os
+import tempfile
+
+
+def convert_model(glb_path: str, out_path: str, fmt: str) -> str:
+    """Convert a cached GLB to fmt. Runs in a worker process."""
+    # Imported here: trimesh is heavy and only needed for conversions
+    import trimesh
+
+    scene_or_mesh = trimesh.load(glb_path, file_type="glb")
+    # Unique temp file: other server processes may convert the same task at once
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(out_path), delete=False, suffix=".part") as tmp:
+        part_path = tmp.name
+    try:
+        scene_or_mesh.export(part_path, file_type=fmt)
+        os.replace(part_path, out_path)
+    except Exception:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+    return out_path